@@ -1,12 +1,17 @@
 import os
+import re
+import csv
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-import json
-from decimal import Decimal
-from flask import Flask, request, jsonify
+import orjson
+from flask import Flask, request
 from dotenv import load_dotenv
-import unicodedata
+import functools
+import bisect
+import threading
+import time
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
@@ -19,263 +24,330 @@ app = Flask(__name__)
 SHOPIFY_URL = os.getenv("SHOPIFY_URL")
 SHOPIFY_API_TOKEN = os.getenv("SHOPIFY_API_TOKEN")
 
+# Tags y metafield 'constante' de varios productos en una sola llamada.
+PRODUCTOS_QUERY = """
+query($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on Product {
+      id
+      tags
+      metafield(namespace: "custom", key: "constante") { value }
+    }
+  }
+}
+"""
+
+# Timeout (conexión, lectura) en segundos para cada llamada a Shopify, para que
+# un Shopify lento no deje bloqueado al worker indefinidamente.
+SHOPIFY_TIMEOUT = (3.05, 10)
+
+# Sesión HTTP compartida: reutiliza las conexiones keep-alive hacia Shopify
+# en lugar de abrir una conexión TCP+TLS nueva en cada llamada.
+SESSION = requests.Session()
+SESSION.headers.update({
+    "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
+    "Content-Type": "application/json"
+})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# CSV de tarifas de envío, junto a este archivo
+ARCHIVO_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), "envios_pendientes - Hoja 1.csv")
+
+# Upsert de varios metafields en una sola llamada.
+METAFIELDS_SET_MUTATION = """
+mutation($metafields: [MetafieldsSetInput!]!) {
+  metafieldsSet(metafields: $metafields) {
+    metafields { id }
+    userErrors { field message }
+  }
+}
+"""
+
+# Caché en memoria de productos: {product_id: (timestamp, (tags, constante))}
+CACHE_PRODUCTOS_TTL = 300
+CACHE_PRODUCTOS_MAX = 4096
+_CACHE_PRODUCTOS = {}
+_CACHE_PRODUCTOS_LOCK = threading.Lock()
+
 ###############################################################################
 # 1. FUNCIONES AUXILIARES
 ###############################################################################
 
+# Shipping lines de preventa: 'preventa' en el título, sin importar mayúsculas
+_PREVENTA_RE = re.compile(r"preventa", re.IGNORECASE)
+
+# Vocales acentuadas, diéresis, eñe y cedilla (ya en minúsculas) -> ASCII
+_TABLA_ACENTOS = str.maketrans(
+    "áàâäãéèêëíìîïóòôöõúùûüñç",
+    "aaaaaeeeeiiiiooooouuuunc"
+)
+
 def normalizar_cadena(texto):
     """
     Convierte la cadena a minúsculas, elimina tildes y espacios sobrantes.
     """
     if not texto:
         return ""
-    texto = texto.strip().lower()
-    texto = ''.join(
-        c for c in unicodedata.normalize('NFD', texto)
-        if unicodedata.category(c) != 'Mn'
-    )
-    return texto
+    return texto.strip().lower().translate(_TABLA_ACENTOS)
 
 def obtener_pedido(order_id):
     """
     Retorna el objeto JSON de un pedido de Shopify usando su order_id.
     """
     url = f"https://{SHOPIFY_URL}/admin/api/2023-10/orders/{order_id}.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-        "Content-Type": "application/json"
-    }
-    resp = requests.get(url, headers=headers)
+    resp = SESSION.get(url, timeout=SHOPIFY_TIMEOUT)
     resp.raise_for_status()
-    return resp.json()["order"]
+    return orjson.loads(resp.content)["order"]
 
-def obtener_constante_producto(product_id):
+def _parsear_constante(valor_raw):
     """
-    Obtiene el metafield 'constante' (namespace=custom, key=constante) de tipo money.
-    Si el valor está en formato JSON, se extrae 'amount'. Retorna 0 si no existe.
+    Convierte el valor del metafield 'constante' (money) a float.
     """
-    url = (
-        f"https://{SHOPIFY_URL}/admin/api/2023-10/products/{product_id}/"
-        "metafields.json?namespace=custom&key=constante"
-    )
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-        "Content-Type": "application/json"
+    try:
+        # Por si la value se guardó como JSON {"amount":"500.00","currency_code":"MXN"}
+        valor_json = orjson.loads(valor_raw)
+        return float(valor_json.get("amount", 0))
+    except Exception:
+        # Si no es JSON, tomamos el valor tal cual
+        return float(valor_raw)
+
+def _consultar_productos(product_ids):
+    """
+    Obtiene en una sola consulta GraphQL los tags y el metafield 'constante'
+    (namespace=custom, key=constante) de varios productos.
+    Retorna {product_id: (tags, constante)}; 'tags' es un frozenset en
+    minúsculas y 'constante' es 0 si no existe.
+    """
+    url = f"https://{SHOPIFY_URL}/admin/api/2023-10/graphql.json"
+    payload = {
+        "query": PRODUCTOS_QUERY,
+        "variables": {"ids": [f"gid://shopify/Product/{pid}" for pid in product_ids]}
     }
-    resp = requests.get(url, headers=headers)
+    resp = SESSION.post(url, data=orjson.dumps(payload), timeout=SHOPIFY_TIMEOUT)
     resp.raise_for_status()
-    metafields = resp.json().get("metafields", [])
-    if metafields:
-        valor_raw = metafields[0]["value"]
-        try:
-            # Por si la value se guardó como JSON {"amount":"500.00","currency_code":"MXN"}
-            valor_json = json.loads(valor_raw)  
-            valor = float(valor_json.get("amount", 0))
-        except Exception:
-            # Si no es JSON, tomamos el valor tal cual
-            valor = float(valor_raw)
-        logging.info(f"Producto {product_id}: Obtenido 'constante' = {valor}")
-        return valor
-
-    logging.info(f"Producto {product_id}: No se encontró metafield 'constante'")
-    return 0.0
-
-def obtener_tarifa_local(
-    peso_kg,
-    estado,
-    archivo_csv="envios_pendientes - Hoja 1.csv"
-):
+    body = orjson.loads(resp.content)
+    if body.get("errors"):
+        raise requests.exceptions.HTTPError(f"GraphQL errors: {body['errors']}", response=resp)
+
+    productos = {}
+    for node in body["data"]["nodes"]:
+        if not node:
+            continue
+        product_id = int(node["id"].rsplit("/", 1)[-1])
+        metafield = node.get("metafield")
+        if metafield:
+            constante = _parsear_constante(metafield["value"])
+            logging.debug("Producto %s: Obtenido 'constante' = %s", product_id, constante)
+        else:
+            constante = 0.0
+            logging.debug("Producto %s: No se encontró metafield 'constante'", product_id)
+        tags = frozenset(t.strip().lower() for t in node.get("tags", []))
+        productos[product_id] = (tags, constante)
+    return productos
+
+def fetch_products_bulk(product_ids):
+    """
+    Igual que _consultar_productos, pero sirve desde la caché en memoria los
+    productos consultados hace menos de CACHE_PRODUCTOS_TTL segundos y solo
+    pide a Shopify los que faltan.
     """
-    Retorna (tarifa, paqueteria) según un archivo CSV local.
+    ahora = time.monotonic()
+    productos = {}
+    faltantes = []
+    with _CACHE_PRODUCTOS_LOCK:
+        for product_id in dict.fromkeys(product_ids):
+            if not product_id:
+                # Line items personalizados o de productos borrados no tienen producto
+                continue
+            entrada = _CACHE_PRODUCTOS.get(product_id)
+            if entrada and ahora - entrada[0] < CACHE_PRODUCTOS_TTL:
+                productos[product_id] = entrada[1]
+            else:
+                faltantes.append(product_id)
+
+    if faltantes:
+        nuevos = _consultar_productos(faltantes)
+        with _CACHE_PRODUCTOS_LOCK:
+            for product_id, datos in nuevos.items():
+                # Reinsertar al final para que el orden del dict sea el de antigüedad
+                _CACHE_PRODUCTOS.pop(product_id, None)
+                _CACHE_PRODUCTOS[product_id] = (ahora, datos)
+            while len(_CACHE_PRODUCTOS) > CACHE_PRODUCTOS_MAX:
+                _CACHE_PRODUCTOS.pop(next(iter(_CACHE_PRODUCTOS)))
+        productos.update(nuevos)
+    return productos
+
+def _procesar_item(order_id, item, productos):
+    """
+    Retorna el subtotal pendiente (constante * quantity) de un line item,
+    o 0 si el producto no tiene el tag 'yo'.
+    """
+    product_id = item.get("product_id")
+    quantity = item["quantity"]
+    product_tags, constante = productos.get(product_id, (frozenset(), 0.0))
+
+    if "yo" not in product_tags:
+        return 0.0
+
+    subtotal = constante * quantity
+    logging.debug(
+        "Pedido %s: Producto %s (qty %s) suma %s a cantidad pendiente",
+        order_id, product_id, quantity, subtotal
+    )
+    return subtotal
+
+def cargar_tarifas(archivo_csv):
+    """
+    Lee el CSV de tarifas una sola vez: lista de filas
+    (ubicacion_normalizada, peso_kg, tarifa, paqueteria) ordenadas por peso_kg.
+    """
+    with open(archivo_csv, newline="", encoding="utf-8") as f:
+        filas = [
+            (
+                normalizar_cadena(row["ubicacion"]),
+                float(row["peso_kg"]),
+                float(row["tarifa"]),
+                row["paqueteria"],
+            )
+            for row in csv.DictReader(f)
+        ]
+    filas.sort(key=lambda fila: fila[1])
+    return filas
+
+def indexar_tarifas(filas):
+    """
+    Agrupa las tarifas por 'ubicacion_normalizada':
+    {ubicacion: (pesos, tarifas, paqueterias)} con los pesos en orden ascendente,
+    listo para buscar con bisect.
+    """
+    indice = {}
+    for ubicacion, peso, tarifa, paqueteria in filas:
+        pesos, tarifas, paqueterias = indice.setdefault(ubicacion, ([], [], []))
+        pesos.append(peso)
+        tarifas.append(tarifa)
+        paqueterias.append(paqueteria)
+    return indice
+
+TARIFAS = indexar_tarifas(cargar_tarifas(ARCHIVO_CSV))
+
+def obtener_tarifa_local(peso_kg, estado):
+    """
+    Retorna (tarifa, paqueteria) según el CSV local de tarifas.
     - 'tarifa' (float)
     - 'paqueteria' (str)
 
-    1) Normaliza el nombre de 'ubicacion' del CSV y el 'estado' ingresado.
+    1) Normaliza el 'estado' ingresado (la 'ubicacion' del CSV ya viene normalizada).
     2) Hace un filtro parcial (p.ej. 'guerrero' -> 'Estado de Guerrero').
     3) Luego toma la fila con peso_kg >= peso_kg y retorna la primera tarifa.
     """
-    df = pd.read_csv(archivo_csv)
-    df["ubicacion_normalizada"] = df["ubicacion"].apply(normalizar_cadena)
+    return _obtener_tarifa_cacheada(round(peso_kg, 3), estado)
+
+@functools.lru_cache(maxsize=128)
+def _obtener_tarifa_cacheada(peso_kg, estado):
     estado_normalizado = normalizar_cadena(estado)
 
-    df_match = df[df["ubicacion_normalizada"].str.contains(estado_normalizado, na=False)]
-    if df_match.empty:
-        logging.info(f"Para peso {peso_kg}kg y estado '{estado}', no se encontró tarifa aplicable.")
+    candidatos = [
+        tabla for ubicacion, tabla in TARIFAS.items()
+        if estado_normalizado in ubicacion
+    ]
+    if not candidatos:
+        logging.info("Para peso %skg y estado '%s', no se encontró tarifa aplicable.", peso_kg, estado)
         return 0.0, ""
 
-    df_aplicable = df_match[df_match["peso_kg"] >= peso_kg].sort_values("peso_kg")
-    if not df_aplicable.empty:
-        row = df_aplicable.iloc[0]
-        tarifa = float(row["tarifa"])
-        paqueteria = str(row["paqueteria"])
+    # Entre todas las ubicaciones que coinciden, la fila con el menor peso_kg >= peso_kg
+    mejor = None
+    for pesos, tarifas, paqueterias in candidatos:
+        idx = bisect.bisect_left(pesos, peso_kg)
+        if idx < len(pesos) and (mejor is None or pesos[idx] < mejor[0]):
+            mejor = (pesos[idx], tarifas[idx], paqueterias[idx])
+
+    if mejor is not None:
+        _, tarifa, paqueteria = mejor
         logging.info(
-            f"Para peso {peso_kg}kg y estado '{estado}' (normalizado='{estado_normalizado}'), "
-            f"tarifa={tarifa}, paqueteria={paqueteria}"
+            "Para peso %skg y estado '%s' (normalizado='%s'), tarifa=%s, paqueteria=%s",
+            peso_kg, estado, estado_normalizado, tarifa, paqueteria
         )
         return tarifa, paqueteria
 
-    logging.info(f"Para peso {peso_kg}kg y estado '{estado}' no se encontró tarifa por peso.")
+    logging.info("Para peso %skg y estado '%s' no se encontró tarifa por peso.", peso_kg, estado)
     return 0.0, ""
 
-# ---------------------------------------------------------------------------
-# Función de guardado que funcionó previamente para 'cantidad_pendiente_productos'
-# ---------------------------------------------------------------------------
-def guardar_metafield_pedido(order_id, key, value):
+def _valor_money(value):
     """
-    Crea o actualiza un metafield de tipo money en el pedido.
-    Se espera que la definición en Shopify tenga:
-      - namespace: custom
-      - key: EXACTAMENTE lo que se pasa (por ejemplo, "cantidad_pendiente_productos")
-      - type: money
-    Enviamos el valor como JSON: {"amount": "X.YY", "currency_code": "MXN"}
+    Valor de un metafield money: JSON {"amount": "X.YY", "currency_code": "MXN"}
     """
-    currency_code = "MXN"
-    valor_str = f"{Decimal(value):.2f}"
-    value_json_str = json.dumps({"amount": valor_str, "currency_code": currency_code})
-
-    url = f"https://{SHOPIFY_URL}/admin/api/2023-10/orders/{order_id}/metafields.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "metafield": {
-            "namespace": "custom",
-            "key": key,
-            "value": value_json_str,
-            "type": "money"
-        }
-    }
-    resp = requests.post(url, headers=headers, json=payload)
-    if resp.status_code == 422 and "already exists" in resp.text:
-        existing_mf_url = f"{url}?namespace=custom&key={key}"
-        existing_mf_resp = requests.get(existing_mf_url, headers=headers)
-        existing_metafields = existing_mf_resp.json().get("metafields", [])
-        if existing_metafields:
-            metafield_id = existing_metafields[0]["id"]
-            update_url = f"https://{SHOPIFY_URL}/admin/api/2023-10/metafields/{metafield_id}.json"
-            upd_resp = requests.put(update_url, headers=headers, json=payload)
-            upd_resp.raise_for_status()
-            logging.info(f"Pedido {order_id}: Metafield '{key}' actualizado a {value_json_str}")
-            return
-    else:
-        resp.raise_for_status()
-    logging.info(f"Pedido {order_id}: Metafield '{key}' configurado a {value_json_str}")
-
-# ---------------------------------------------------------------------------
-# Función para guardar metafields de tipo money (para los otros campos)
-# ---------------------------------------------------------------------------
-def guardar_metafield_pedido_money(order_id, key, value):
-    currency_code = "MXN"
-    valor_str = f"{Decimal(value):.2f}"
-    value_json_str = json.dumps({"amount": valor_str, "currency_code": currency_code})
-
-    url = f"https://{SHOPIFY_URL}/admin/api/2023-10/orders/{order_id}/metafields.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "metafield": {
-            "namespace": "custom",
-            "key": key,
-            "value": value_json_str,
-            "type": "money"
-        }
-    }
-    resp = requests.post(url, headers=headers, json=payload)
-    if resp.status_code == 422 and "already exists" in resp.text:
-        existing_mf_url = f"{url}?namespace=custom&key={key}"
-        existing_mf_resp = requests.get(existing_mf_url, headers=headers)
-        existing_metafields = existing_mf_resp.json().get("metafields", [])
-        if existing_metafields:
-            metafield_id = existing_metafields[0]["id"]
-            update_url = f"https://{SHOPIFY_URL}/admin/api/2023-10/metafields/{metafield_id}.json"
-            upd_resp = requests.put(update_url, headers=headers, json=payload)
-            upd_resp.raise_for_status()
-            logging.info(f"Pedido {order_id}: Metafield '{key}' actualizado a {value_json_str}")
-            return
-    else:
-        resp.raise_for_status()
-    logging.info(f"Pedido {order_id}: Metafield '{key}' configurado a {value_json_str}")
+    valor_str = format(float(value), ".2f")
+    return orjson.dumps({"amount": valor_str, "currency_code": "MXN"}).decode()
 
-def guardar_metafield_pedido_text(order_id, key, value):
+def set_metafields_bulk(owner_gid, entries):
     """
-    Crea o actualiza un metafield de tipo texto (single_line_text_field) en el pedido.
+    Crea o actualiza (upsert) varios metafields (namespace=custom) de un recurso
+    con una sola mutación GraphQL metafieldsSet.
+    Cada entrada es {"key": ..., "type": ..., "value": ...}.
     """
-    url = f"https://{SHOPIFY_URL}/admin/api/2023-10/orders/{order_id}/metafields.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-        "Content-Type": "application/json"
-    }
+    url = f"https://{SHOPIFY_URL}/admin/api/2023-10/graphql.json"
     payload = {
-        "metafield": {
-            "namespace": "custom",
-            "key": key,
-            "value": str(value),
-            "type": "single_line_text_field"
+        "query": METAFIELDS_SET_MUTATION,
+        "variables": {
+            "metafields": [
+                {"ownerId": owner_gid, "namespace": "custom", **entry}
+                for entry in entries
+            ]
         }
     }
+    resp = SESSION.post(url, data=orjson.dumps(payload), timeout=SHOPIFY_TIMEOUT)
+    resp.raise_for_status()
+    body = orjson.loads(resp.content)
+    errores = body.get("errors") or body["data"]["metafieldsSet"]["userErrors"]
+    if errores:
+        raise requests.exceptions.HTTPError(f"metafieldsSet errors: {errores}", response=resp)
 
-    resp = requests.post(url, headers=headers, json=payload)
-    if resp.status_code == 422 and "already exists" in resp.text:
-        existing_mf_url = f"{url}?namespace=custom&key={key}"
-        existing_mf_resp = requests.get(existing_mf_url, headers=headers)
-        existing_metafields = existing_mf_resp.json().get("metafields", [])
-        if existing_metafields:
-            metafield_id = existing_metafields[0]["id"]
-            update_url = f"https://{SHOPIFY_URL}/admin/api/2023-10/metafields/{metafield_id}.json"
-            upd_resp = requests.put(update_url, headers=headers, json=payload)
-            upd_resp.raise_for_status()
-            logging.info(f"Pedido {order_id}: Metafield (texto) '{key}' actualizado a '{value}'")
-            return
-    else:
-        resp.raise_for_status()
-    logging.info(f"Pedido {order_id}: Metafield (texto) '{key}' configurado a '{value}'")
-
-###############################################################################
-# 2. ENDPOINT WEBHOOK
-###############################################################################
-
-@app.route("/webhook/order_created", methods=["POST"])
-def webhook_order_created():
-    data = request.get_json()
-    if not data:
-        logging.error("Webhook sin datos JSON")
-        return jsonify({"error": "No JSON data received"}), 400
-
-    order = data.get("order") or data
+def guardar_metafields_pedido(order_id, cantidad_pendiente_productos, envio_pendiente,
+                              total_pendiente, paqueteria):
+    """
+    Guarda en el pedido los metafields 'cantidad_pendiente_productos',
+    'envio_pendiente', 'pendiente_pago' (money) y 'paqueteria_' (texto).
+    """
+    entries = [
+        {"key": "cantidad_pendiente_productos", "type": "money",
+         "value": _valor_money(cantidad_pendiente_productos)},
+        {"key": "envio_pendiente", "type": "money", "value": _valor_money(envio_pendiente)},
+        {"key": "pendiente_pago", "type": "money", "value": _valor_money(total_pendiente)},
+    ]
+    # Shopify rechaza valores vacíos y la mutación es atómica: sin paquetería
+    # no se envía, para no perder los demás campos.
+    if paqueteria:
+        entries.append({"key": "paqueteria_", "type": "single_line_text_field", "value": str(paqueteria)})
+
+    set_metafields_bulk(f"gid://shopify/Order/{order_id}", entries)
+    for entry in entries:
+        logging.debug("Pedido %s: Metafield '%s' configurado a %s", order_id, entry["key"], entry["value"])
+
+def procesar_pedido(order):
+    """
+    Calcula y guarda en el pedido los metafields de preventa:
+    1) 'cantidad_pendiente_productos': suma de constante * quantity de los productos con tag 'yo'.
+    2) 'envio_pendiente' y 'paqueteria_': tarifa local si algún shipping line es de preventa.
+    3) 'pendiente_pago': productos + envío.
+    Retorna un dict con los valores calculados; propaga los errores HTTP de Shopify.
+    """
     order_id = order["id"]
     line_items = order.get("line_items", [])
     shipping_lines = order.get("shipping_lines", [])
-    shipping_address = order.get("shipping_address", {})
+    shipping_address = order.get("shipping_address") or {}
 
     # 1. Calcular 'cantidad_pendiente_productos'
-    cantidad_pendiente_productos = 0.0
-    for item in line_items:
-        product_id = item["product_id"]
-        quantity = item["quantity"]
-        prod_url = f"https://{SHOPIFY_URL}/admin/api/2023-10/products/{product_id}.json?fields=tags"
-        headers = {
-            "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-            "Content-Type": "application/json"
-        }
-        resp_prod = requests.get(prod_url, headers=headers)
-        resp_prod.raise_for_status()
-        product_tags = resp_prod.json()["product"]["tags"].split(",")
-
-        if "yo" in [t.strip() for t in product_tags]:
-            constante = obtener_constante_producto(product_id)
-            subtotal = constante * quantity
-            cantidad_pendiente_productos += subtotal
-            logging.info(
-                f"Pedido {order_id}: Producto {product_id} (qty {quantity}) suma {subtotal} a cantidad pendiente"
-            )
+    productos = fetch_products_bulk([it.get("product_id") for it in line_items])
+    cantidad_pendiente_productos = sum(_procesar_item(order_id, it, productos) for it in line_items)
 
     # 2. Determinar si incluye "preventa"
     envio_pendiente = 0.0
     paqueteria = ""
-    has_preventa = any("preventa" in sl.get("title", "").lower() for sl in shipping_lines)
+    has_preventa = any(_PREVENTA_RE.search(sl.get("title") or "") for sl in shipping_lines)
 
     if has_preventa:
         peso_total_kg = float(order.get("total_weight", 0)) / 1000.0
@@ -283,122 +355,85 @@ def webhook_order_created():
         envio_pendiente, paqueteria = obtener_tarifa_local(peso_total_kg, estado)
     else:
         logging.info(
-            f"Pedido {order_id}: Ningún shipping line contiene 'preventa', "
-            "no se calcula ni guarda costo de envío."
+            "Pedido %s: Ningún shipping line contiene 'preventa', "
+            "no se calcula ni guarda costo de envío.", order_id
         )
 
     # 3. Calcular 'pendiente_pago' (productos + envío)
     total_pendiente = cantidad_pendiente_productos + envio_pendiente
 
     # 4. Guardar los metafields
-    try:
-        # Aquí usamos la función que funcionó para "cantidad_pendiente_productos"
-        guardar_metafield_pedido(order_id, "cantidad_pendiente_productos", cantidad_pendiente_productos)
-        guardar_metafield_pedido_money(order_id, "envio_pendiente", envio_pendiente)
-        guardar_metafield_pedido_money(order_id, "pendiente_pago", total_pendiente)
-        guardar_metafield_pedido_text(order_id, "paqueteria_", paqueteria)
-        logging.info(
-            f"Pedido {order_id}: Metafields guardados. Productos={cantidad_pendiente_productos}, "
-            f"Envío={envio_pendiente}, Total={total_pendiente}, Paqueteria='{paqueteria}'"
-        )
-
-    except requests.exceptions.HTTPError as http_err:
-        logging.error(
-            f"Pedido {order_id}: Error al guardar metafields (HTTPError) - {http_err} "
-            f"Response Body: {http_err.response.text}"
-        )
-        return jsonify({"error": str(http_err), "response_body": http_err.response.text}), 500
-    except Exception as e:
-        logging.error(f"Pedido {order_id}: Error al guardar metafields - {e}")
-        return jsonify({"error": str(e)}), 500
+    guardar_metafields_pedido(
+        order_id, cantidad_pendiente_productos, envio_pendiente, total_pendiente, paqueteria
+    )
+    logging.info(
+        "Pedido %s: Metafields guardados. Productos=%s, Envío=%s, Total=%s, Paqueteria='%s'",
+        order_id, cantidad_pendiente_productos, envio_pendiente, total_pendiente, paqueteria
+    )
 
-    return jsonify({
-        "status": "Metafields actualizados",
+    return {
         "order_id": order_id,
         "cantidad_pendiente_productos": cantidad_pendiente_productos,
         "envio_pendiente": envio_pendiente,
         "pendiente_pago": total_pendiente,
         "paqueteria": paqueteria
-    }), 200
+    }
 
-###############################################################################
-# 3. ENDPOINT MANUAL (similar lógica)
-###############################################################################
+def respuesta_json(payload, status):
+    """
+    Respuesta Flask con el payload serializado por orjson.
+    """
+    return app.response_class(orjson.dumps(payload), status=status, mimetype="application/json")
 
-@app.route("/actualizar_pedido/<int:order_id>", methods=["GET"])
-def actualizar_pedido_manual(order_id):
+def responder_pedido(order, status):
+    """
+    Ejecuta procesar_pedido y arma la respuesta HTTP del endpoint.
+    """
+    order_id = order["id"]
     try:
-        order = obtener_pedido(order_id)
+        resultado = procesar_pedido(order)
+    except requests.exceptions.HTTPError as http_err:
+        logging.error(
+            "Pedido %s: Error al procesar pedido (HTTPError) - %s Response Body: %s",
+            order_id, http_err, http_err.response.text
+        )
+        return respuesta_json({"error": str(http_err), "response_body": http_err.response.text}, 500)
     except Exception as e:
-        logging.error(f"Pedido {order_id}: No se pudo obtener - {e}")
-        return jsonify({"error": "No se pudo obtener el pedido"}), 400
+        logging.error("Pedido %s: Error al procesar pedido - %s", order_id, e)
+        return respuesta_json({"error": str(e)}, 500)
 
-    line_items = order.get("line_items", [])
-    shipping_lines = order.get("shipping_lines", [])
-    shipping_address = order.get("shipping_address", {})
-
-    cantidad_pendiente_productos = 0.0
-    for item in line_items:
-        product_id = item["product_id"]
-        quantity = item["quantity"]
-        headers = {
-            "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-            "Content-Type": "application/json"
-        }
-        prod_url = f"https://{SHOPIFY_URL}/admin/api/2023-10/products/{product_id}.json?fields=tags"
-        resp_prod = requests.get(prod_url, headers=headers)
-        resp_prod.raise_for_status()
-        product_tags = resp_prod.json()["product"]["tags"].split(",")
+    return respuesta_json({"status": status, **resultado}, 200)
 
-        if "yo" in [t.strip() for t in product_tags]:
-            constante = obtener_constante_producto(product_id)
-            cantidad_pendiente_productos += (constante * quantity)
+###############################################################################
+# 2. ENDPOINT WEBHOOK
+###############################################################################
 
-    # Determinar si se incluye 'preventa'
-    has_preventa = any("preventa" in sl.get("title", "").lower() for sl in shipping_lines)
+@app.route("/webhook/order_created", methods=["POST"])
+def webhook_order_created():
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = None
+    if not data:
+        logging.error("Webhook sin datos JSON")
+        return respuesta_json({"error": "No JSON data received"}, 400)
 
-    envio_pendiente = 0.0
-    paqueteria = ""
-    if has_preventa:
-        peso_total_kg = float(order.get("total_weight", 0)) / 1000.0
-        estado = shipping_address.get("province", "") or ""
-        envio_pendiente, paqueteria = obtener_tarifa_local(peso_total_kg, estado)
-    else:
-        logging.info(
-            f"Pedido {order_id}: No se detectó 'preventa' en ningún shipping line. "
-            "Costo de envío = 0."
-        )
+    order = data.get("order") or data
+    return responder_pedido(order, "Metafields actualizados")
 
-    total_pendiente = cantidad_pendiente_productos + envio_pendiente
+###############################################################################
+# 3. ENDPOINT MANUAL (misma lógica, obteniendo el pedido de Shopify)
+###############################################################################
 
+@app.route("/actualizar_pedido/<int:order_id>", methods=["GET"])
+def actualizar_pedido_manual(order_id):
     try:
-        guardar_metafield_pedido(order_id, "cantidad_pendiente_productos", cantidad_pendiente_productos)
-        guardar_metafield_pedido_money(order_id, "envio_pendiente", envio_pendiente)
-        guardar_metafield_pedido_money(order_id, "pendiente_pago", total_pendiente)
-        guardar_metafield_pedido_text(order_id, "paqueteria_", paqueteria)
-
-        logging.info(
-            f"Pedido {order_id}: Metafields (manual) configurados. Productos={cantidad_pendiente_productos}, "
-            f"Envío={envio_pendiente}, Total={total_pendiente}, Paqueteria='{paqueteria}'"
-        )
-    except requests.exceptions.HTTPError as http_err:
-        logging.error(
-            f"Pedido {order_id}: Error HTTP al guardar metafields - {http_err} "
-            f"Response Body: {http_err.response.text}"
-        )
-        return jsonify({"error": str(http_err), "response_body": http_err.response.text}), 500
+        order = obtener_pedido(order_id)
     except Exception as e:
-        logging.error(f"Pedido {order_id}: Error al guardar metafields manualmente - {e}")
-        return jsonify({"error": str(e)}), 500
+        logging.error("Pedido %s: No se pudo obtener - %s", order_id, e)
+        return respuesta_json({"error": "No se pudo obtener el pedido"}, 400)
 
-    return jsonify({
-        "status": "Metafields actualizados (manual)",
-        "order_id": order_id,
-        "cantidad_pendiente_productos": cantidad_pendiente_productos,
-        "envio_pendiente": envio_pendiente,
-        "pendiente_pago": total_pendiente,
-        "paqueteria": paqueteria
-    }), 200
+    return responder_pedido(order, "Metafields actualizados (manual)")
 
 ###############################################################################
 # 4. EJECUCIÓN DE LA APLICACIÓN FLASK